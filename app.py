@@ -2,17 +2,131 @@ import streamlit as st
 import zipfile
 import os
 import tempfile
-from pathlib import Path
-from PIL import Image
-from pillow_heif import register_heif_opener
-import io
+import time
+import hashlib
+import glob
+import threading
+from collections import OrderedDict
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import multiprocessing
+
+import converter
+from converter import convert_keyed, init_worker, probe_hwaccel, save_options
+
+# Optional: ISA-L provides a SIMD-accelerated zlib/CRC32
+try:
+    from isal import isal_zlib
+except ImportError:
+    isal_zlib = None
+
+# Zip entries are stored uncompressed, so CRC32 is the only zlib work left;
+# route it through ISA-L when installed
+if isal_zlib is not None:
+    zipfile.crc32 = isal_zlib.crc32
 
-# Register HEIF opener with Pillow
-register_heif_opener()
 __version__ = "0.1.0"
 
+# Limits on converted files kept for reuse across reruns
+CACHE_MAX_ENTRIES = 64
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Batches of at most this many files are converted on threads instead of processes
+THREAD_BATCH_SIZE = 4
+
+# Spooled zips older than this are swept from the temp directory
+ZIP_MAX_AGE_SECONDS = 6 * 60 * 60
+
+# Write buffer for the output zip file
+ZIP_WRITE_BUFFER_SIZE = 1 << 20
+
+# Start pool workers without forking the multithreaded Streamlit server, which
+# could hand a child a lock held by another session's decode thread
+_MP_CONTEXT = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+
 st.set_page_config(page_title="HEIC Converter", page_icon="🖼️", layout="wide")
 
+
+# Register HEIF opener with Pillow once per process rather than on every rerun;
+# this also sets up the converter for small batches run on threads
+@st.cache_resource(show_spinner=False)
+def _init_heif():
+    init_worker()
+    return True
+
+
+_init_heif()
+
+
+def _remove_zip(path):
+    """Delete a spooled zip file, ignoring files that are already gone."""
+    if path:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _sweep_old_zips():
+    """Delete spooled zips left behind by sessions that ended without cleanup."""
+    cutoff = time.time() - ZIP_MAX_AGE_SECONDS
+    for path in glob.glob(os.path.join(tempfile.gettempdir(), "heic_converted_*.zip")):
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def _read_zip(path):
+    """Read a spooled zip; only called when the user actually downloads it."""
+    with open(path, "rb") as zip_file:
+        return zip_file.read()
+
+
+# Converted outputs shared across reruns and sessions, oldest evicted first
+@st.cache_resource(show_spinner=False)
+def _conversion_cache():
+    return OrderedDict(), threading.Lock()
+
+
+def _cache_store(cache, cache_lock, key, value):
+    """Add a converted file, evicting the oldest until within both cache limits."""
+    if len(value[1]) > CACHE_MAX_BYTES:
+        return
+    with cache_lock:
+        cache[key] = value
+        cache_bytes = sum(len(data) for _, data in cache.values())
+        while len(cache) > CACHE_MAX_ENTRIES or cache_bytes > CACHE_MAX_BYTES:
+            _, (_, evicted) = cache.popitem(last=False)
+            cache_bytes -= len(evicted)
+
+
+def _run_jobs(jobs):
+    """Convert (key, args) jobs in parallel, yielding results as they finish."""
+    workers = min(os.cpu_count() or 1, len(jobs))
+    if len(jobs) <= THREAD_BATCH_SIZE:
+        # libheif and Pillow release the GIL while decoding and encoding, so
+        # threads overlap one file's decode with another's encode without the
+        # cost of starting worker processes
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(convert_keyed, job) for job in jobs]
+            for future in as_completed(futures):
+                yield future.result()
+    else:
+        # Decode/encode files in parallel across all cores
+        with _MP_CONTEXT.Pool(workers, initializer=init_worker) as pool:
+            yield from pool.imap_unordered(convert_keyed, jobs)
+
+
+# Probe FFmpeg for a hardware HEVC decoder once per process
+@st.cache_resource(show_spinner=False)
+def _probe_hwaccel():
+    return probe_hwaccel()
+
+
 st.title("🖼️ HEIC to PNG/JPG Converter")
 st.markdown("Upload HEIC files and convert them to PNG or JPG format with customizable quality settings.")
 
@@ -39,6 +153,43 @@ with st.sidebar:
         quality = None
         st.info("PNG format is lossless and doesn't use quality settings.")
     
+    # 16-bit PNG output for 10/12-bit HEICs (requires pypng)
+    keep_depth = False
+    if output_format == "PNG" and converter.png is not None:
+        keep_depth = st.checkbox(
+            "Keep original bit depth",
+            value=False,
+            help="Save 10/12-bit HDR photos as 16-bit PNGs instead of reducing them to 8 bits. Ignored when resizing."
+        )
+    
+    # Encoder speed vs. output size
+    compression = st.radio(
+        "Compression",
+        ["Fast", "Small"],
+        help="Fast skips the slow optimizing encoder passes, Small produces slightly smaller files"
+    )
+    
+    # Optional downscaling of large photos
+    max_dim = st.slider(
+        "Max output dimension",
+        min_value=0,
+        max_value=8192,
+        value=0,
+        step=256,
+        help="Longest side of the output in pixels. 0 keeps the original size."
+    )
+    
+    # Hardware HEVC decoding through FFmpeg, if this machine supports it
+    hwaccel = _probe_hwaccel()
+    if hwaccel:
+        use_hwaccel = st.checkbox(
+            f"Hardware decode ({hwaccel})",
+            value=False,
+            help="Decode with FFmpeg on the GPU. Falls back to the software decoder if FFmpeg fails. Transparency is not preserved."
+        )
+        if not use_hwaccel:
+            hwaccel = None
+    
     st.markdown("### ℹ️ How it works")
     st.info("After conversion, click the Download button to save the zip file to your computer. You'll be able to choose where to save it.")
 
@@ -61,91 +212,98 @@ if uploaded_files:
     # Convert button
     if st.button("🔄 Convert Files", type="primary", use_container_width=True):
         with st.spinner("Converting files... This may take a moment."):
-            # Create temporary directory for converted files
-            with tempfile.TemporaryDirectory() as temp_dir:
-                converted_files = []
-                errors = []
-                
-                progress_bar = st.progress(0)
-                status_text = st.empty()
-                
-                for idx, uploaded_file in enumerate(uploaded_files):
-                    try:
-                        # Update progress
-                        progress = (idx + 1) / len(uploaded_files)
-                        progress_bar.progress(progress)
-                        status_text.text(f"Processing {uploaded_file.name} ({idx + 1}/{len(uploaded_files)})...")
-                        
-                        # Read HEIC file
-                        image_data = uploaded_file.read()
-                        
-                        # Open HEIC image
-                        image = Image.open(io.BytesIO(image_data))
-                        
-                        # Convert to RGB if necessary (for JPG)
-                        if output_format == "JPG" and image.mode in ("RGBA", "LA", "P"):
-                            # Create white background for transparent images
-                            rgb_image = Image.new("RGB", image.size, (255, 255, 255))
-                            if image.mode == "P":
-                                image = image.convert("RGBA")
-                            rgb_image.paste(image, mask=image.split()[-1] if image.mode == "RGBA" else None)
-                            image = rgb_image
-                        elif output_format == "JPG":
-                            image = image.convert("RGB")
-                        
-                        # Generate output filename
-                        base_name = Path(uploaded_file.name).stem
-                        extension = "png" if output_format == "PNG" else "jpg"
-                        output_filename = f"{base_name}.{extension}"
-                        output_path = os.path.join(temp_dir, output_filename)
-                        
-                        # Save converted image
-                        if output_format == "PNG":
-                            image.save(output_path, format="PNG", optimize=True)
-                        else:
-                            image.save(output_path, format="JPEG", quality=quality, optimize=True)
-                        
-                        converted_files.append((output_path, output_filename))
-                        
-                    except Exception as e:
-                        errors.append(f"{uploaded_file.name}: {str(e)}")
-                        st.warning(f"⚠️ Failed to convert {uploaded_file.name}: {str(e)}")
-                
-                progress_bar.progress(1.0)
-                status_text.text("Creating zip file...")
+            converted_files = []
+            errors = []
+
+            progress_bar = st.progress(0)
+            status_text = st.empty()
+
+            # Reuse earlier results for identical uploads and settings
+            cache, cache_lock = _conversion_cache()
+            settings = (output_format, quality, compression, hwaccel, max_dim, keep_depth)
+            extension, save_kwargs = save_options(output_format, quality, compression)
+
+            # Grab upload bytes up front so the jobs can be sent to worker processes;
+            # getvalue() hands back the UploadedFile's own buffer without copying it
+            jobs = []
+            for uploaded_file in uploaded_files:
+                data = uploaded_file.getvalue()
+                key = (uploaded_file.name, hashlib.blake2b(data).hexdigest(), settings)
+                with cache_lock:
+                    cached = cache.get(key)
+                    if cached is not None:
+                        cache.move_to_end(key)
+                if cached is not None:
+                    converted_files.append(cached)
+                else:
+                    jobs.append((key, (uploaded_file.name, data, extension, save_kwargs, hwaccel, max_dim, keep_depth)))
+
+            done = len(converted_files)
+            total = len(uploaded_files)
+            if jobs:
+                last_update = time.monotonic()
+                for key, (filename, data, error) in _run_jobs(jobs):
+                    done += 1
+
+                    # Update progress at most every 250 ms to limit websocket chatter
+                    if time.monotonic() - last_update > 0.25 or done == total:
+                        progress_bar.progress(done / total)
+                        status_text.text(f"Processed {filename} ({done}/{total})...")
+                        last_update = time.monotonic()
+
+                    if error is None:
+                        converted_files.append((filename, data))
+                        _cache_store(cache, cache_lock, key, (filename, data))
+                    else:
+                        errors.append(f"{filename}: {error}")
+                        st.warning(f"⚠️ Failed to convert {filename}: {error}")
+
+            progress_bar.progress(1.0)
+            status_text.text("Creating zip file...")
+            
+            # Drop the previous conversion's zip, and any abandoned by other
+            # sessions, before building a new one
+            _remove_zip(st.session_state.pop("zip_path", None))
+            _sweep_old_zips()
+
+            if converted_files:
+                # Spool the zip to a temp file; it is only read back into memory
+                # when the user clicks download
+                zip_filename = f"heic_converted_{output_format.lower()}.zip"
+                fd, zip_path = tempfile.mkstemp(prefix=f"heic_converted_{output_format.lower()}_", suffix=".zip")
+                os.close(fd)
                 
-                if converted_files:
-                    # Create zip file in memory
-                    zip_buffer = io.BytesIO()
-                    zip_filename = f"heic_converted_{output_format.lower()}.zip"
+                try:
+                    # PNG/JPEG are already compressed, so store them as-is
+                    # and write through a 1 MB buffer to keep write() calls large
+                    with open(zip_path, "wb", buffering=ZIP_WRITE_BUFFER_SIZE) as zip_out:
+                        with zipfile.ZipFile(zip_out, 'w', zipfile.ZIP_STORED, allowZip64=True) as zipf:
+                            for filename, data in converted_files:
+                                zipf.writestr(filename, data)
                     
-                    try:
-                        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                            for file_path, filename in converted_files:
-                                zipf.write(file_path, filename)
-                        
-                        # Get zip file size
-                        zip_size = len(zip_buffer.getvalue()) / (1024 * 1024)  # MB
-                        
-                        # Store zip data in session state for download
-                        st.session_state.zip_data = zip_buffer.getvalue()
-                        st.session_state.zip_filename = zip_filename
-                        st.session_state.conversion_complete = True
-                        st.session_state.converted_count = len(converted_files)
-                        st.session_state.zip_size = zip_size
-                        st.session_state.conversion_errors = errors
-                        st.session_state.output_format = output_format
-                        
-                    except Exception as e:
-                        st.error(f"❌ Failed to create zip file: {e}")
-                        st.session_state.conversion_complete = False
-                else:
-                    st.error("❌ No files were successfully converted.")
+                    # Get zip file size
+                    zip_size = os.path.getsize(zip_path) / (1024 * 1024)  # MB
+                    
+                    # Store only the zip path in session state for download
+                    st.session_state.zip_path = zip_path
+                    st.session_state.zip_filename = zip_filename
+                    st.session_state.conversion_complete = True
+                    st.session_state.converted_count = len(converted_files)
+                    st.session_state.zip_size = zip_size
+                    st.session_state.conversion_errors = errors
+                    st.session_state.output_format = output_format
+                    
+                except Exception as e:
+                    st.error(f"❌ Failed to create zip file: {e}")
+                    _remove_zip(zip_path)
                     st.session_state.conversion_complete = False
-                
-                # Clear progress indicators
-                progress_bar.empty()
-                status_text.empty()
+            else:
+                st.error("❌ No files were successfully converted.")
+                st.session_state.conversion_complete = False
+            
+            # Clear progress indicators
+            progress_bar.empty()
+            status_text.empty()
 
 # Show download section if conversion is complete
 if st.session_state.get("conversion_complete", False):
@@ -160,16 +318,22 @@ if st.session_state.get("conversion_complete", False):
     st.markdown("### 📥 Download Your Files")
     st.info("Click the button below to download your converted files. You'll be able to choose where to save the zip file on your computer.")
     
-    if st.download_button(
-        label=f"📥 Download {st.session_state.get('zip_filename', 'converted_files.zip')}",
-        data=st.session_state.get("zip_data", b""),
-        file_name=st.session_state.get("zip_filename", "heic_converted.zip"),
-        mime="application/zip",
-        use_container_width=True,
-        type="primary"
-    ):
-        st.balloons()
-        st.success("Download started! Check your browser's download folder or the location you selected.")
+    zip_path = st.session_state.get("zip_path")
+    if zip_path and os.path.exists(zip_path):
+        # Deferred data: the zip is read on click, not on every rerun
+        downloaded = st.download_button(
+            label=f"📥 Download {st.session_state.get('zip_filename', 'converted_files.zip')}",
+            data=partial(_read_zip, zip_path),
+            file_name=st.session_state.get("zip_filename", "heic_converted.zip"),
+            mime="application/zip",
+            use_container_width=True,
+            type="primary"
+        )
+        if downloaded:
+            st.balloons()
+            st.success("Download started! Check your browser's download folder or the location you selected.")
+    else:
+        st.warning("⚠️ The converted zip file is no longer available. Please convert the files again.")
     
     # Show errors if any
     errors = st.session_state.get("conversion_errors", [])
@@ -0,0 +1,233 @@
+"""Conversion worker used by the app's process pool.
+
+This lives outside app.py because Streamlit executes the script as a fake
+``__main__`` module, which pool workers cannot import functions from.
+"""
+import io
+import os
+import subprocess
+import tempfile
+import zlib
+from pathlib import Path
+import numpy as np
+from PIL import Image
+from pillow_heif import open_heif, register_heif_opener
+
+# Optional: libjpeg-turbo bindings for faster JPEG encoding
+try:
+    from turbojpeg import TJPF_RGB, TJSAMP_420, TurboJPEG
+except ImportError:
+    TurboJPEG = None
+
+# Optional: pypng can write 16-bit RGB(A) PNGs, which Pillow cannot
+try:
+    import png
+except ImportError:
+    png = None
+
+# FFmpeg hardware decoders to try, in order of preference
+HWACCEL_PREFERENCE = ("cuda", "videotoolbox", "qsv", "vaapi")
+
+# Seconds before a stuck FFmpeg decode is abandoned for the software decoder
+FFMPEG_DECODE_TIMEOUT = 30
+
+# Per-process TurboJPEG encoder, created in init_worker when available
+_turbojpeg = None
+
+
+def init_worker():
+    """Pool initializer: register the HEIF opener and load libjpeg-turbo."""
+    global _turbojpeg
+    register_heif_opener()
+    if TurboJPEG is not None:
+        try:
+            _turbojpeg = TurboJPEG()
+        except (OSError, RuntimeError):
+            # Python bindings installed but the shared library is missing
+            _turbojpeg = None
+
+
+def probe_hwaccel():
+    """Return the preferred FFmpeg hwaccel available on this machine, or None."""
+    try:
+        result = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-hwaccels"],
+            capture_output=True, text=True, timeout=10, check=True
+        )
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+    available = set(result.stdout.split())
+    for hwaccel in HWACCEL_PREFERENCE:
+        if hwaccel in available:
+            return hwaccel
+    return None
+
+
+def decode_ffmpeg(data, hwaccel):
+    """Decode HEIC bytes to an RGB image using FFmpeg's hardware HEVC decoder."""
+    # libheif only parses the container here; the HEVC payload is not decoded
+    heif = open_heif(data)
+    width, height = heif.size
+
+    # The HEIF demuxer needs a seekable input, so go through a temp file
+    fd, tmp_path = tempfile.mkstemp(suffix=".heic")
+    try:
+        with os.fdopen(fd, "wb") as tmp:
+            tmp.write(data)
+        result = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-loglevel", "error", "-hwaccel", hwaccel,
+             "-i", tmp_path, "-frames:v", "1", "-f", "image2pipe",
+             "-vcodec", "ppm", "-pix_fmt", "rgb24", "-"],
+            capture_output=True, check=True, timeout=FFMPEG_DECODE_TIMEOUT
+        )
+    finally:
+        os.remove(tmp_path)
+
+    # PPM carries its own dimensions, so a frame that is only the first tile
+    # of a gridded HEIC, or one missing the irot rotation, is rejected
+    image = Image.open(io.BytesIO(result.stdout))
+    if image.size != (width, height):
+        raise ValueError("FFmpeg output does not match the image size")
+    image.load()
+
+    # Carry over the colour profile (often Display P3) as the libheif path does
+    icc_profile = heif.info.get("icc_profile")
+    if icc_profile:
+        image.info["icc_profile"] = icc_profile
+    return image
+
+
+def encode_png_high_bit_depth(data, compress_level):
+    """Encode a 10/12-bit HEIC as a 16-bit PNG, streaming rows through pypng.
+
+    Returns None for 8-bit images or pixel layouts this path doesn't handle,
+    so the caller can fall back to the regular Pillow encoder.
+    """
+    heif = open_heif(data, convert_hdr_to_8bit=False)
+    if heif.info.get("bit_depth", 8) <= 8 or heif.mode not in ("RGB;16", "RGBA;16"):
+        return None
+
+    # Strip row padding and view the decoded buffer as native 16-bit samples
+    width, height = heif.size
+    channels = 4 if heif.mode == "RGBA;16" else 3
+    rows = np.frombuffer(heif.data, dtype=np.uint8).reshape(height, heif.stride)
+    pixels = rows[:, :width * channels * 2].view(np.uint16)
+
+    # PNG stores 16-bit samples big-endian; convert one row at a time
+    writer = png.Writer(
+        width, height, greyscale=False, alpha=channels == 4,
+        bitdepth=16, compression=compress_level
+    )
+    buf = io.BytesIO()
+    writer.write_packed(buf, (row.astype(">u2").tobytes() for row in pixels))
+
+    # pypng has no ICC option, so splice an iCCP chunk in after IHDR the way
+    # Pillow's PNG encoder would, keeping wide-gamut colours correct
+    icc_profile = heif.info.get("icc_profile")
+    if icc_profile:
+        chunks = list(png.Reader(bytes=buf.getvalue()).chunks())
+        chunks.insert(1, (b"iCCP", b"ICC Profile\0\0" + zlib.compress(icc_profile)))
+        buf = io.BytesIO()
+        png.write_chunks(buf, chunks)
+    return buf.getvalue()
+
+
+def save_options(output_format, quality, compression):
+    """Return the ``(extension, save_kwargs)`` pair for the chosen settings.
+
+    Computed once per batch so workers don't re-derive it for every file.
+    """
+    fast = compression == "Fast"
+    if output_format == "PNG":
+        if fast:
+            return "png", {"format": "PNG", "optimize": False, "compress_level": 1}
+        return "png", {"format": "PNG", "optimize": True, "compress_level": 9}
+    # HEIC photos store chroma at 4:2:0, so keep that instead of upsampling it
+    return "jpg", {"format": "JPEG", "quality": quality, "optimize": not fast, "progressive": False, "subsampling": 2}
+
+
+def convert_one(args):
+    """Convert a single HEIC file.
+
+    Takes a ``(name, data, extension, save_kwargs, hwaccel, max_dim, keep_depth)``
+    tuple, with ``extension`` and ``save_kwargs`` from save_options, a
+    ``max_dim`` of 0 keeping the original size and ``keep_depth`` requesting
+    16-bit PNG output for HDR images, and returns
+    ``(output_filename, image_bytes, None)`` on success or
+    ``(name, None, error_message)`` on failure.
+    """
+    name, data, extension, save_kwargs, hwaccel, max_dim, keep_depth = args
+    jpg = save_kwargs["format"] == "JPEG"
+    try:
+        # Generate output filename
+        base_name = Path(name).stem
+        output_filename = f"{base_name}.{extension}"
+
+        # HDR to 16-bit PNG skips Pillow, which would reduce it to 8 bits
+        if keep_depth and not jpg and not max_dim and png is not None:
+            png_bytes = encode_png_high_bit_depth(data, save_kwargs["compress_level"])
+            if png_bytes is not None:
+                return output_filename, png_bytes, None
+
+        # Open HEIC image, preferring hardware decode and falling back to libheif
+        image = None
+        if hwaccel:
+            try:
+                image = decode_ffmpeg(data, hwaccel)
+            except (OSError, subprocess.SubprocessError, ValueError):
+                image = None
+        if image is None:
+            # BytesIO shares the bytes object until written to, so this is not a copy
+            image = Image.open(io.BytesIO(data))
+
+        # Downscale large images; thumbnail() already lets the decoder draft
+        # a reduced image with headroom for LANCZOS
+        if max_dim:
+            image.thumbnail((max_dim, max_dim), Image.Resampling.LANCZOS)
+
+        # Convert to RGB if necessary (for JPG)
+        if jpg and image.mode in ("RGBA", "LA", "P"):
+            if "A" not in image.getbands():
+                image = image.convert("RGBA")
+            # getchannel only extracts the alpha plane, unlike split()
+            alpha = image.getchannel("A")
+            if alpha.getextrema() == (255, 255):
+                # Fully opaque, so there is nothing to composite
+                image = image.convert("RGB")
+            else:
+                # Blend transparent images onto white in a single vectorized pass
+                if image.mode != "RGBA":
+                    image = image.convert("RGBA")
+                arr = np.asarray(image)
+                a = arr[..., 3:4].astype(np.uint16)
+                rgb = (arr[..., :3].astype(np.uint16) * a + 255 * (255 - a)) // 255
+                image = Image.fromarray(rgb.astype(np.uint8))
+        elif jpg and image.mode != "RGB":
+            image = image.convert("RGB")
+
+        # Encode converted image; the optimizing JPEG pass stays with Pillow
+        if jpg and not save_kwargs["optimize"] and _turbojpeg is not None:
+            jpg_bytes = _turbojpeg.encode(
+                np.asarray(image), quality=save_kwargs["quality"],
+                pixel_format=TJPF_RGB, jpeg_subsample=TJSAMP_420
+            )
+            return output_filename, jpg_bytes, None
+
+        buf = io.BytesIO()
+        image.save(buf, **save_kwargs)
+
+        return output_filename, buf.getvalue(), None
+
+    except Exception as e:
+        return name, None, str(e)
+
+
+def convert_keyed(job):
+    """Run convert_one on a ``(key, args)`` pair and return ``(key, result)``.
+
+    The key is passed through untouched so callers can match results from
+    ``imap_unordered`` back to their inputs.
+    """
+    key, args = job
+    return key, convert_one(args)